@@ -0,0 +1,241 @@
+import json
+import sys
+from typing import Any
+
+COURSE_SCHEMA: dict[str, type] = {
+    "classroom": list,
+    "live_classes": list,
+    "announcements": list,
+    "lessons": list,
+}
+
+LESSON_SCHEMA: dict[str, type] = {
+    "videos": list,
+    "notes": list,
+}
+
+DEDUP_SCAN_LIMIT = 32
+
+def is_blank(x: Any) -> bool:
+    if x is None:
+        return True
+    t = type(x)
+    if t is str or t is list or t is dict:
+        return not x
+    return False
+
+def sid_of(v: Any) -> str | None:
+    return sys.intern(str(v)) if v is not None else None
+
+def _member_key(x: Any) -> Any:
+    t = type(x)
+    try:
+        if t is dict:
+            return ("d", frozenset(x.items()))
+        if t is list:
+            k = ("l", tuple(x))
+            hash(k)
+            return k
+    except TypeError:
+        return ("j", json.dumps(x, sort_keys=True, default=str))
+    return ("v", x)
+
+def _seen_keys(items: list, key: str | None = None) -> set:
+    return {
+        _member_key(x)
+        for x in items
+        if key is None or type(x) is not dict or x.get(key) in (None, "")
+    }
+
+def _append_unique(target: list, seen: set | None, item: Any) -> None:
+    if seen is None:
+        if item not in target:
+            target.append(item)
+        return
+    k = _member_key(item)
+    if k not in seen:
+        seen.add(k)
+        target.append(item)
+
+def merge_dict_fill_only(existing: dict, new: dict | None) -> None:
+    stack: list[tuple[dict, dict]] = [(existing, new or {})]
+    while stack:
+        e, n = stack.pop()
+        for k, v in n.items():
+            t = type(v)
+            if t is dict:
+                sub = e.get(k)
+                if type(sub) is not dict:
+                    sub = e[k] = {}
+                stack.append((sub, v))
+            elif t is list:
+                if type(e.get(k)) is not list:
+                    e[k] = []
+            else:
+                if not is_blank(e.get(k)):
+                    continue
+                if v is not None and v != "":
+                    e[k] = v
+
+def _normalize(node: dict, schema: dict[str, type]) -> None:
+    for k, t in schema.items():
+        if k in node and type(node[k]) is not t:
+            node[k] = t()
+
+def merge_list_by_key(existing_list: Any, new_list: list, key: str = "id", index: dict | None = None) -> list:
+    if index is None:
+        index = {}
+    if type(existing_list) is not list:
+        existing_list = []
+        index.clear()
+    if not new_list:
+        return existing_list
+
+    if not index:
+        index.update({
+            sid_of(item_id): i
+            for i, item in enumerate(existing_list)
+            if type(item) is dict and (item_id := item.get(key)) not in (None, "")
+        })
+
+    seen: set | None = None
+    hashed = len(existing_list) + len(new_list) >= DEDUP_SCAN_LIMIT
+    for item in new_list:
+        if type(item) is not dict or item.get(key) in (None, ""):
+            if hashed and seen is None:
+                seen = _seen_keys(existing_list, key)
+            _append_unique(existing_list, seen, item)
+            continue
+
+        item_id = item[key]
+
+        sid = sid_of(item_id)
+        if (i := index.get(sid)) is not None:
+            merge_dict_fill_only(existing_list[i], item)
+        else:
+            index[sid] = len(existing_list)
+            existing_list.append(item)
+
+    return existing_list
+
+def fingerprint(item: Any) -> tuple:
+    if type(item) is not dict:
+        return ("s", str(item))
+
+    v = item.get("id")
+    if not is_blank(v):
+        return ("id", sid_of(v))
+
+    for k in ("notice_id", "_id", "update_id", "uid"):
+        v = item.get(k)
+        if not is_blank(v):
+            return (k, sid_of(v))
+
+    return ("ts", item.get("published_at") or "", item.get("content") or "")
+
+def merge_list_by_fingerprint(existing_list: Any, new_list: list, idx: dict | None = None) -> list:
+    if idx is None:
+        idx = {}
+    if type(existing_list) is not list:
+        existing_list = []
+        idx.clear()
+    if not new_list:
+        return existing_list
+
+    if not idx:
+        idx.update((fingerprint(item), i) for i, item in enumerate(existing_list))
+
+    for item in new_list:
+        fp = fingerprint(item)
+        if (i := idx.get(fp)) is not None:
+            target = existing_list[i]
+            if type(target) is dict and type(item) is dict:
+                merge_dict_fill_only(target, item)
+        else:
+            idx[fp] = len(existing_list)
+            existing_list.append(item)
+
+    return existing_list
+
+def merge_course(existing_course: dict, new_course: dict) -> None:
+    _normalize(new_course, COURSE_SCHEMA)
+    for lesson in new_course.get("lessons", []):
+        if type(lesson) is dict:
+            _normalize(lesson, LESSON_SCHEMA)
+
+    merge_dict_fill_only(existing_course, new_course)
+
+    cache = existing_course.setdefault("__idx", {})
+
+    existing_course["classroom"] = merge_list_by_key(
+        existing_course.get("classroom", []),
+        new_course.get("classroom", []),
+        key="id",
+        index=cache.setdefault("classroom", {})
+    )
+
+    existing_course["live_classes"] = merge_list_by_key(
+        existing_course.get("live_classes", []),
+        new_course.get("live_classes", []),
+        key="id",
+        index=cache.setdefault("live_classes", {})
+    )
+
+    existing_course["announcements"] = merge_list_by_fingerprint(
+        existing_course.get("announcements", []),
+        new_course.get("announcements", []),
+        idx=cache.setdefault("announcements", {})
+    )
+
+    lesson_idx = cache.setdefault("lessons", {})
+
+    existing_lessons = existing_course.get("lessons", [])
+    if type(existing_lessons) is not list:
+        existing_lessons = []
+        lesson_idx.clear()
+
+    if not lesson_idx:
+        lesson_idx.update({
+            sid_of(lid): i
+            for i, l in enumerate(existing_lessons)
+            if type(l) is dict and (lid := l.get("lesson_id")) not in (None, "")
+        })
+
+    new_lessons = new_course.get("lessons", [])
+    seen: set | None = None
+    hashed = len(existing_lessons) + len(new_lessons) >= DEDUP_SCAN_LIMIT
+    for lesson in new_lessons:
+        if type(lesson) is not dict or lesson.get("lesson_id") in (None, ""):
+            if hashed and seen is None:
+                seen = _seen_keys(existing_lessons, "lesson_id")
+            _append_unique(existing_lessons, seen, lesson)
+            continue
+
+        lid = sid_of(lesson["lesson_id"])
+        if (i := lesson_idx.get(lid)) is not None:
+            target = existing_lessons[i]
+            merge_dict_fill_only(target, lesson)
+            target["videos"] = merge_list_by_key(
+                target.get("videos", []),
+                lesson.get("videos", []),
+                key="id"
+            )
+            if lesson.get("notes"):
+                if type(target.get("notes")) is not list:
+                    target["notes"] = []
+                notes = target["notes"]
+                new_notes = lesson["notes"]
+                notes_seen = _seen_keys(notes) if len(notes) + len(new_notes) >= DEDUP_SCAN_LIMIT else None
+                for n in new_notes:
+                    _append_unique(notes, notes_seen, n)
+            target["lesson_count"] = len(target["videos"])
+        else:
+            if "videos" in lesson:
+                lesson["lesson_count"] = len(lesson["videos"])
+            lesson_idx[lid] = len(existing_lessons)
+            existing_lessons.append(lesson)
+
+    existing_course["lessons"] = existing_lessons
+    existing_course["lesson_count"] = sum(
+        len(l.get("videos", [])) for l in existing_lessons if type(l) is dict
+    )
@@ -1,11 +1,20 @@
 import os
 import time
 import random
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from merge import merge_course, sid_of
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 BASE = os.getenv("BASE_URL")
 if not BASE:
@@ -33,231 +42,165 @@ HEADERS = {
 }
 
 THREADS = int(os.getenv("THREADS", "3"))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "16"))
 MASTER_JSON_FILE = "master_courses.json"
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "25"))
+FETCH_TTL = int(os.getenv("FETCH_TTL", "3600"))
+FORCE_REFRESH = os.getenv("FORCE_REFRESH", "").lower() in ("1", "true", "yes")
+
+RUN_STARTED = datetime.now(timezone.utc)
+FETCHED_AT = RUN_STARTED.isoformat()
 
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "5"))
 BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", "0.8"))
 BACKOFF_CAP = float(os.getenv("BACKOFF_CAP", "10"))
-REQUEST_JITTER = float(os.getenv("REQUEST_JITTER", "0.15"))
+REQUEST_RATE = float(os.getenv("REQUEST_RATE", "20"))
+REQUEST_BURST = float(os.getenv("REQUEST_BURST", "20"))
 
 session = requests.Session()
-
-def ensure_list(x):
-    if isinstance(x, list):
-        return x
-    if isinstance(x, dict):
-        return [x]
-    return []
-
-def safe_get(url):
+session.headers.update(HEADERS)
+_adapter = HTTPAdapter(pool_maxsize=THREADS + FETCH_WORKERS)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+RESPONSE_CACHE_SIZE = 4096
+_response_cache = {}
+
+_rate_lock = threading.Lock()
+_rate_tokens = REQUEST_BURST
+_rate_updated = time.monotonic()
+
+def throttle():
+    global _rate_tokens, _rate_updated
+    if REQUEST_RATE <= 0:
+        return
+    with _rate_lock:
+        now = time.monotonic()
+        _rate_tokens = min(REQUEST_BURST, _rate_tokens + (now - _rate_updated) * REQUEST_RATE)
+        _rate_updated = now
+        _rate_tokens -= 1
+        wait = -_rate_tokens / REQUEST_RATE
+    if wait > 0:
+        time.sleep(wait)
+
+def _get_raw(url):
+    delay = BACKOFF_BASE
     for attempt in range(1, MAX_RETRIES + 1):
-        if REQUEST_JITTER > 0:
-            time.sleep(random.uniform(0, REQUEST_JITTER))
+        throttle()
         try:
-            r = session.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+            r = session.get(url, timeout=REQUEST_TIMEOUT)
             code = r.status_code
             if code in (500, 502, 503, 504):
-                wait = min(BACKOFF_CAP, BACKOFF_BASE * (2 ** (attempt - 1))) + random.uniform(0, 0.3)
                 if attempt < MAX_RETRIES:
-                    time.sleep(wait)
+                    delay = min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, delay * 3))
+                    time.sleep(delay)
                     continue
-                return []
+                return None
             if code != 200:
-                return []
-            try:
-                return r.json()
-            except Exception:
-                return []
+                return None
+            return r.content
         except requests.RequestException:
-            wait = min(BACKOFF_CAP, BACKOFF_BASE * (2 ** (attempt - 1))) + random.uniform(0, 0.3)
             if attempt < MAX_RETRIES:
-                time.sleep(wait)
+                delay = min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, delay * 3))
+                time.sleep(delay)
                 continue
+            return None
+
+def safe_get(url):
+    raw = _response_cache.get(url)
+    if raw is None:
+        raw = _get_raw(url)
+        if raw is None:
             return []
+        if len(_response_cache) < RESPONSE_CACHE_SIZE:
+            _response_cache[url] = raw
+    try:
+        return decode_json(raw)
+    except Exception:
+        return []
+
+def safe_get_list(url):
+    data = safe_get(url)
+    t = type(data)
+    if t is list:
+        return data
+    if t is dict:
+        return [data]
+    return []
+
+def decode_json(raw):
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw)
+
+def encode_json(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
 
 def load_master_json():
     try:
-        with open(MASTER_JSON_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data if isinstance(data, list) else []
+        with open(MASTER_JSON_FILE, "rb") as f:
+            data = decode_json(f.read())
+        return data if isinstance(data, list) else []
     except FileNotFoundError:
         return []
     except Exception:
         return []
 
 def save_master_json(data):
-    with open(MASTER_JSON_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def is_blank(x):
-    return x in (None, "", [], {})
-
-def merge_scalar_fill_only(existing_dict, k, new_val):
-    if is_blank(existing_dict.get(k)) and not is_blank(new_val):
-        existing_dict[k] = new_val
-
-def merge_dict_fill_only(existing, new):
-    for k, v in (new or {}).items():
-        if isinstance(v, dict):
-            if not isinstance(existing.get(k), dict):
-                existing[k] = {}
-            merge_dict_fill_only(existing[k], v)
-        elif isinstance(v, list):
-            if not isinstance(existing.get(k), list):
-                existing[k] = []
-        else:
-            merge_scalar_fill_only(existing, k, v)
-
-def merge_list_by_key(existing_list, new_list, key="id"):
-    if not isinstance(existing_list, list):
-        existing_list = []
-    if not isinstance(new_list, list):
-        return existing_list
-
-    index = {}
-    for idx, item in enumerate(existing_list):
-        if isinstance(item, dict):
-            item_id = item.get(key)
-            if item_id not in (None, ""):
-                index[str(item_id)] = idx
-
-    for item in new_list:
-        if not isinstance(item, dict):
-            if item not in existing_list:
-                existing_list.append(item)
-            continue
-
-        item_id = item.get(key)
-        if item_id in (None, ""):
-            if item not in existing_list:
-                existing_list.append(item)
-            continue
-
-        sid = str(item_id)
-        if sid in index:
-            merge_dict_fill_only(existing_list[index[sid]], item)
-        else:
-            existing_list.append(item)
-            index[sid] = len(existing_list) - 1
-
-    return existing_list
-
-def fingerprint(item):
-    if not isinstance(item, dict):
-        return str(item)
-
-    for k in ("id", "notice_id", "_id", "update_id", "uid"):
-        v = item.get(k)
-        if v not in (None, "", [], {}):
-            return f"{k}:{v}"
-
-    body = item.get("content") or ""
-    ts = item.get("published_at") or ""
-    return f"{ts}|{hash(body)}"
-
-def merge_list_by_fingerprint(existing_list, new_list):
-    if not isinstance(existing_list, list):
-        existing_list = []
-    if not isinstance(new_list, list):
-        return existing_list
-
-    idx = {fingerprint(item): i for i, item in enumerate(existing_list)}
-
-    for item in new_list:
-        fp = fingerprint(item)
-        if fp in idx:
-            if isinstance(existing_list[idx[fp]], dict) and isinstance(item, dict):
-                merge_dict_fill_only(existing_list[idx[fp]], item)
-        else:
-            existing_list.append(item)
-            idx[fp] = len(existing_list) - 1
-
-    return existing_list
-
-def merge_course(existing_course, new_course):
-    merge_dict_fill_only(existing_course, new_course)
-
-    existing_course["classroom"] = merge_list_by_key(
-        existing_course.get("classroom", []),
-        new_course.get("classroom", []),
-        key="id"
-    )
-
-    existing_course["live_classes"] = merge_list_by_key(
-        existing_course.get("live_classes", []),
-        new_course.get("live_classes", []),
-        key="id"
-    )
-
-    existing_course["announcements"] = merge_list_by_fingerprint(
-        existing_course.get("announcements", []),
-        new_course.get("announcements", [])
-    )
-
-    existing_lessons = existing_course.get("lessons", [])
-    if not isinstance(existing_lessons, list):
-        existing_lessons = []
-
-    new_lessons = new_course.get("lessons", [])
-    if not isinstance(new_lessons, list):
-        new_lessons = []
-
-    lesson_idx = {}
-    for i, l in enumerate(existing_lessons):
-        if isinstance(l, dict):
-            lid = l.get("lesson_id")
-            if lid not in (None, ""):
-                lesson_idx[str(lid)] = i
-
-    for lesson in new_lessons:
-        if not isinstance(lesson, dict):
-            if lesson not in existing_lessons:
-                existing_lessons.append(lesson)
-            continue
-
-        lid = lesson.get("lesson_id")
-        if lid in (None, ""):
-            if lesson not in existing_lessons:
-                existing_lessons.append(lesson)
+    for c in data:
+        if isinstance(c, dict):
+            c.pop("__idx", None)
+    payload = encode_json(data)
+    tmp = MASTER_JSON_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, MASTER_JSON_FILE)
+
+def index_master_json(master_json):
+    course_index = {}
+    known_videos = {}
+    for i, c in enumerate(master_json):
+        if not isinstance(c, dict):
             continue
+        cid = sid_of(c.get("course_id"))
+        course_index.setdefault(cid, i)
+        for l in c.get("lessons") or []:
+            if not isinstance(l, dict):
+                continue
+            lid = sid_of(l.get("lesson_id"))
+            for v in l.get("videos") or []:
+                if isinstance(v, dict) and v.get("m3u") and v.get("yt"):
+                    known_videos[(cid, lid, sid_of(v.get("id")))] = v
+    return course_index, known_videos
 
-        lid = str(lid)
-        if lid in lesson_idx:
-            target = existing_lessons[lesson_idx[lid]]
-            merge_dict_fill_only(target, lesson)
-            target["videos"] = merge_list_by_key(
-                target.get("videos", []),
-                lesson.get("videos", []),
-                key="id"
-            )
-            if isinstance(lesson.get("notes"), list):
-                if not isinstance(target.get("notes"), list):
-                    target["notes"] = []
-                for n in lesson["notes"]:
-                    if n not in target["notes"]:
-                        target["notes"].append(n)
-            if isinstance(target.get("videos"), list):
-                target["lesson_count"] = len(target["videos"])
-        else:
-            if isinstance(lesson.get("videos"), list):
-                lesson["lesson_count"] = len(lesson["videos"])
-            existing_lessons.append(lesson)
-            lesson_idx[lid] = len(existing_lessons) - 1
-
-    existing_course["lessons"] = existing_lessons
-    existing_course["lesson_count"] = sum(
-        len(l.get("videos", [])) for l in existing_lessons if isinstance(l, dict)
-    )
-
-def upsert_course(master_json, course_id, new_course):
-    for c in master_json:
-        if c.get("course_id") == course_id:
-            merge_course(c, new_course)
-            return
+def is_fresh(course, now):
+    try:
+        age = now - datetime.fromisoformat(course.get("fetched_at"))
+    except (TypeError, ValueError):
+        return False
+    return age.total_seconds() < FETCH_TTL
+
+def upsert_course(master_json, course_index, course_id, new_course):
+    i = course_index.get(sid_of(course_id))
+    if i is not None:
+        merge_course(master_json[i], new_course)
+        master_json[i]["fetched_at"] = new_course.get("fetched_at")
+        return
+    course_index[sid_of(course_id)] = len(master_json)
     master_json.append(new_course)
 
-batches = ensure_list(safe_get(f"{BASE}/batches"))
+batches = safe_get_list(f"{BASE}/batches")
 if not batches:
     raise SystemExit
 
@@ -266,16 +209,17 @@ for kw in KEYWORDS:
     m = re.match(r"(\d+)\s+(.*)", kw)
     if m:
         n, w = m.groups()
-        keyword_patterns.append(re.compile(rf"\b{n}(?:st|nd|rd|th)?\s*{re.escape(w)}\b", re.I))
+        keyword_patterns.append(rf"\b{n}(?:st|nd|rd|th)?\s*{re.escape(w)}\b")
     else:
-        keyword_patterns.append(re.compile(rf"\b{re.escape(kw)}\b", re.I))
+        keyword_patterns.append(rf"\b{re.escape(kw)}\b")
+
+KEYWORD_RE = re.compile("|".join(f"(?:{p})" for p in keyword_patterns) or r"(?!)", re.I)
 
 filtered_courses = []
 for item in batches:
     if not isinstance(item, dict):
         continue
-    title = (item.get("title") or "").lower()
-    if not any(p.search(title) for p in keyword_patterns):
+    if not KEYWORD_RE.search(item.get("title") or ""):
         continue
     filtered_courses.append({
         "id": item.get("id"),
@@ -284,11 +228,12 @@ for item in batches:
         "image_thumb": item.get("image_thumb"),
     })
 
-def fetch_course_details(course, rank, total):
+def fetch_course_details(course, rank, total, known_videos):
     cid = course["id"]
+    scid = sid_of(cid)
     out = {
         "ranking": rank,
-        "course_id": str(cid),
+        "course_id": scid,
         "course_name": course.get("title"),
         "image_large": course.get("image_large"),
         "image_thumb": course.get("image_thumb"),
@@ -297,57 +242,88 @@ def fetch_course_details(course, rank, total):
         "live_classes": [],
         "announcements": [],
         "lesson_count": 0,
-        "fetched_at": datetime.now(timezone.utc).isoformat(),
+        "fetched_at": FETCHED_AT,
     }
 
-    classroom = ensure_list(safe_get(f"{BASE}/classroom/{cid}"))
+    live_classes = fetch_pool.submit(safe_get_list, f"{BASE}/today/{cid}")
+    announcements = fetch_pool.submit(safe_get_list, f"{BASE}/updates/{cid}")
+
+    classroom = safe_get_list(f"{BASE}/classroom/{cid}")
     out["classroom"] = classroom
 
-    for cls in classroom:
-        lid = cls.get("id")
-        if not lid:
-            continue
-        lessons = ensure_list(safe_get(f"{BASE}/lesson/{lid}"))
+    video_fetches = {}
+
+    def video_details(lesson_id, v):
+        vid = v.get("id")
+        if not vid:
+            return {}
+        vid = sid_of(vid)
+        known = known_videos.get((scid, lesson_id, vid))
+        if known is not None:
+            return {"video_url": known["m3u"], "hd_video_url": known["yt"]}
+        fut = video_fetches.get(vid)
+        if fut is None:
+            fut = video_fetches[vid] = fetch_pool.submit(safe_get, f"{BASE}/video/{vid}")
+        return fut
+
+    lesson_ids = [cls.get("id") for cls in classroom if cls.get("id")]
+    lesson_groups = fetch_pool.map(safe_get_list, [f"{BASE}/lesson/{lid}" for lid in lesson_ids])
+
+    pending = []
+    for lessons in lesson_groups:
         for l in lessons:
-            videos = []
-            for v in (l.get("videos") or []):
-                vid = v.get("id")
-                vd = safe_get(f"{BASE}/video/{vid}") if vid else {}
-                videos.append({
-                    "id": str(vid),
-                    "name": v.get("name"),
-                    "published_at": v.get("published_at"),
-                    "thumb": v.get("thumb"),
-                    "type": v.get("type"),
-                    "pdfs": v.get("pdfs") or [],
-                    "m3u": vd.get("video_url") if isinstance(vd, dict) else "",
-                    "yt": vd.get("hd_video_url") if isinstance(vd, dict) else "",
-                })
-            out["lessons"].append({
-                "lesson_id": str(l.get("id")),
-                "lesson_name": l.get("name"),
-                "lesson_count": len(videos),
-                "videos": videos,
-                "notes": l.get("notes") or [],
+            metas = l.get("videos") or []
+            lesson_id = str(l.get("id"))
+            pending.append((l, lesson_id, metas, [video_details(lesson_id, v) for v in metas]))
+
+    for l, lesson_id, metas, vds in pending:
+        videos = []
+        for v, vd in zip(metas, vds):
+            if isinstance(vd, Future):
+                vd = vd.result()
+            vid = v.get("id")
+            videos.append({
+                "id": str(vid),
+                "name": v.get("name"),
+                "published_at": v.get("published_at"),
+                "thumb": v.get("thumb"),
+                "type": v.get("type"),
+                "pdfs": v.get("pdfs") or [],
+                "m3u": vd.get("video_url") if isinstance(vd, dict) else "",
+                "yt": vd.get("hd_video_url") if isinstance(vd, dict) else "",
             })
-
-    out["live_classes"] = ensure_list(safe_get(f"{BASE}/today/{cid}"))
-    out["announcements"] = ensure_list(safe_get(f"{BASE}/updates/{cid}"))
+        out["lessons"].append({
+            "lesson_id": lesson_id,
+            "lesson_name": l.get("name"),
+            "lesson_count": len(videos),
+            "videos": videos,
+            "notes": l.get("notes") or [],
+        })
+        out["lesson_count"] += len(videos)
+
+    out["live_classes"] = live_classes.result()
+    out["announcements"] = announcements.result()
     return out
 
 master_json = load_master_json()
-results = []
+course_index, known_videos = index_master_json(master_json)
+total = len(filtered_courses)
+jobs = []
+for i, c in enumerate(filtered_courses):
+    existing = course_index.get(sid_of(c["id"]))
+    if not FORCE_REFRESH and existing is not None and is_fresh(master_json[existing], RUN_STARTED):
+        continue
+    jobs.append((i + 1, c))
+if len(jobs) < total:
+    print(f"skipping {total - len(jobs)} course(s) fetched in the last {FETCH_TTL}s")
 
 with ThreadPoolExecutor(max_workers=THREADS) as ex:
-    futures = [
-        ex.submit(fetch_course_details, c, i + 1, len(filtered_courses))
-        for i, c in enumerate(filtered_courses)
-    ]
-    for f in as_completed(futures):
-        results.append(f.result())
-
-for r in results:
-    upsert_course(master_json, r["course_id"], r)
-
-save_master_json(master_json)
+    for r in ex.map(
+        lambda job: fetch_course_details(job[1], job[0], total, known_videos),
+        jobs,
+    ):
+        upsert_course(master_json, course_index, r["course_id"], r)
+
+if jobs or not os.path.exists(MASTER_JSON_FILE):
+    save_master_json(master_json)
 print("done")